@@ -7,8 +7,11 @@ import signal
 import logging
 import json
 import sys
+import threading
+import uuid
 
 from logging.handlers import TimedRotatingFileHandler
+from collections import deque
 from gpiozero import CPUTemperature
 from pathlib import Path
 from logging.handlers import TimedRotatingFileHandler
@@ -17,6 +20,12 @@ from logging.handlers import TimedRotatingFileHandler
 loopEnabled = True
 CONFIG = {}
 STAT_CACHE = {}
+COMMAND_TRACES = {}
+COMMAND_LATENCIES = {}
+LATENCY_WINDOW = 100
+POLL_INTERVAL = 5.0
+COMMAND_TIMEOUT = 3 * POLL_INTERVAL
+TRACE_LOCK = threading.Lock()
 
 def configureLogger() -> None:
     logger = logging.getLogger()
@@ -101,15 +110,17 @@ def read_config() -> bool:
         CONFIG = {}
         return False
 
-def toggle(pin: int):
+def toggle(pin: int, trace: dict = None):
   GPIO.output(pin, GPIO.LOW)
+  stampTrace(trace, "relay_low")
   time.sleep(0.1)
   GPIO.output(pin, GPIO.HIGH)
+  stampTrace(trace, "relay_high")
 
 def get(pin: int) -> bool:
     return GPIO.input(pin)
 
-def moveDoor(door: str, command: str):
+def moveDoor(door: str, command: str, trace: dict = None):
     global STAT_CACHE
 
     pin = -1
@@ -126,7 +137,7 @@ def moveDoor(door: str, command: str):
     elif command == "HALF":
         pin = CONFIG["fence"]["gpio"]["half"]
 
-    if pin > -1: toggle(pin)
+    if pin > -1: toggle(pin, trace)
     STAT_CACHE[door]["command"] = command if command != "STOP" else ""
     STAT_CACHE[door]["last_command_time"] = time.perf_counter() if command != "STOP" else 0
 
@@ -267,21 +278,177 @@ def switchLight(on: bool):
 def getLight():
     return "OFF" #TODO 
 
-def evaluateCommand(topic: str, command: str):
+def newCommandTrace(topic: str, command: str) -> dict:
+    # stamp an inbound command with a trace id, timings are perf_counter values
+    trace = {}
+    trace["trace_id"] = uuid.uuid4().hex[:12]
+    trace["topic"] = topic
+    trace["command"] = command
+    trace["door"] = ""
+    trace["received"] = round(time.time(), 3)
+    trace["dispatched"] = False
+    trace["acked"] = False
+    trace["timings"] = {}
+    trace["timings"]["decode"] = time.perf_counter()
+    return trace
+
+def stampTrace(trace: dict, stage: str) -> None:
+    # record the first time a command reaches a stage
+    if trace is None:
+        return
+    with TRACE_LOCK:
+        if stage not in trace["timings"]:
+            trace["timings"][stage] = time.perf_counter()
+
+def traceTimings(trace: dict) -> dict:
+    # milliseconds relative to decode
+    with TRACE_LOCK:
+        timings = dict(trace["timings"])
+    decoded = timings["decode"]
+    return {stage: round((stamp - decoded) * 1000, 1) for stage, stamp in timings.items()}
+
+def recordLatencies(door: str, command: str, timings: dict, outcome: str = "") -> dict:
+    # keep a rolling window per door, command and stage, count the final outcomes and return the statistics
+    global COMMAND_LATENCIES
+
+    with TRACE_LOCK:
+        stats = COMMAND_LATENCIES.setdefault(door, {}).setdefault(command, {"stages": {}, "outcomes": {}})
+
+        if outcome:
+            stats["outcomes"][outcome] = stats["outcomes"].get(outcome, 0) + 1
+
+        for stage, latency in timings.items():
+            if stage == "decode":
+                continue
+            stats["stages"].setdefault(stage, deque(maxlen=LATENCY_WINDOW)).append(latency)
+
+        percentiles = {}
+        for stage, window in stats["stages"].items():
+            values = sorted(window)
+            percentiles[stage] = {}
+            percentiles[stage]["count"] = len(values)
+            for p in [50, 90, 99]:
+                # nearest-rank percentile
+                percentiles[stage]["p" + str(p)] = values[max(-(-p * len(values) // 100) - 1, 0)]
+
+        return {"latency_percentiles_ms": percentiles, "outcomes": dict(stats["outcomes"])}
+
+def mqttPushCommandResult(mqttclient, trace: dict, result: str, complete: bool, reason: str = "", extra: dict = None) -> None:
+    # the command topic ends with "/command", so this goes to <door topic>/command/result
+    # complete marks the final result for a trace
+    data = {}
+    data["trace_id"] = trace["trace_id"]
+    data["command"] = trace["command"]
+    data["result"] = result
+    if reason:
+        data["reason"] = reason
+    data["complete"] = complete
+    data["received"] = trace["received"]
+    data["timings_ms"] = traceTimings(trace)
+    if extra:
+        data.update(extra)
+
+    if reason:
+        logging.info("Command %s %s: %s (%s) %s", trace["trace_id"], trace["command"], result, reason, json.dumps(data["timings_ms"]))
+    else:
+        logging.info("Command %s %s: %s %s", trace["trace_id"], trace["command"], result, json.dumps(data["timings_ms"]))
+    mqttclient.publish(trace["topic"] + "/result", json.dumps(data), qos=CONFIG["mqtt"]["qos"])
+
+def mqttFinishCommandTrace(mqttclient, trace: dict, result: str, extra: dict = None) -> None:
+    # final result for a trace that waited for a state publish, only acks add a state publish latency
+    timings = {}
+    if result == "ack":
+        timings["state_publish"] = traceTimings(trace)["state_publish"]
+
+    data = recordLatencies(trace["door"], trace["command"], timings, result)
+    if extra:
+        data.update(extra)
+    mqttPushCommandResult(mqttclient, trace, result, True, extra=data)
+
+def registerCommandTrace(trace: dict) -> dict:
+    # make the trace the pending one of its door and return the trace it replaces
+    global COMMAND_TRACES
+
+    with TRACE_LOCK:
+        superseded = COMMAND_TRACES.pop(trace["door"], None)
+        COMMAND_TRACES[trace["door"]] = trace
+
+    return superseded
+
+def mqttCloseCommandTrace(mqttclient, door: str, published: bool) -> None:
+    # the first state publish after an accepted command closes its trace, otherwise it times out
+    global COMMAND_TRACES
+
+    with TRACE_LOCK:
+        trace = COMMAND_TRACES.get(door)
+        if trace is None or not trace["dispatched"]:
+            return
+
+        if published and "state_publish" not in trace["timings"]:
+            trace["timings"]["state_publish"] = time.perf_counter()
+
+        if not trace["acked"]:
+            # mqttOnMessage is still sending the first ack and closes the trace afterwards
+            return
+
+        if "state_publish" in trace["timings"]:
+            result = "ack"
+        elif time.perf_counter() - trace["timings"]["decode"] > COMMAND_TIMEOUT:
+            result = "timeout"
+        else:
+            return
+
+        COMMAND_TRACES.pop(door)
+
+    mqttFinishCommandTrace(mqttclient, trace, result)
+
+def commandChangesState(door: str, command: str) -> bool:
+    # commands leaving the published state untouched get their complete ack right after dispatch
+    if command in ["LIGHT_ON", "LIGHT_OFF"]:
+        # switching the light is not implemented yet, getLight does not change
+        return False
+
+    with TRACE_LOCK:
+        pending = door in COMMAND_TRACES
+    if pending or STAT_CACHE[door]["command"]:
+        # the cached state is outdated while a command is in flight, wait for its own publish
+        return True
+
+    if command == "STOP":
+        # the door is idle, moveDoor does not fire the impulse relay
+        return False
+    elif command == "OPEN":
+        return not (STAT_CACHE[door]["state"] == "OPEN" and STAT_CACHE[door]["position"] == 100)
+    elif command == "CLOSE":
+        return STAT_CACHE[door]["state"] != "CLOSED"
+    elif command == "VENTING":
+        return STAT_CACHE[door]["venting"] != "ON"
+    elif command == "HALF":
+        return STAT_CACHE[door]["half"] != "ON"
+
+    return True
+
+def evaluateCommand(topic: str, command: str) -> tuple[str, str]:
+    # returns the door the command is meant for, otherwise "" and the reason for rejecting it
     if topic == CONFIG["garage"]["mqtt"]["topic"] + "/command" and CONFIG["garage"]["enabled"]: 
-        if command in ["OPEN", "CLOSE", "STOP", "VENTING"]:
-            moveDoor("garage", command)
-        elif command == "LIGHT_OFF":
-            switchLight(False)
-        elif command == "LIGHT_ON":
-            switchLight(True)
-        #else: do nothing
+        if command in ["OPEN", "CLOSE", "STOP", "VENTING", "LIGHT_OFF", "LIGHT_ON"]:
+            return "garage", ""
+        return "", "unknown command"
     elif topic == CONFIG["fence"]["mqtt_topic"] + "/command" and CONFIG["fence"]["enabled"]:
         if command in ["OPEN", "CLOSE", "STOP", "HALF"]:
-            moveDoor("fence", command)
-        #else: do nothing    
-    #else: do nothing
-    pass
+            return "fence", ""
+        return "", "unknown command"
+
+    return "", "unknown topic"
+
+def executeCommand(door: str, command: str, trace: dict = None) -> None:
+    stampTrace(trace, "dispatch")
+    if command == "LIGHT_OFF":
+        switchLight(False)
+    elif command == "LIGHT_ON":
+        switchLight(True)
+    else:
+        moveDoor(door, command, trace)
 
 def mqttBuildTopic(type: str, device_id: str, name_suffix: str) -> str:
     return "homeassistant/" + type + "/" + device_id + "/" + device_id + "_" + name_suffix + "/config"
@@ -383,8 +550,57 @@ def mqttOnDisconnect(mqttclient, userdata, rc):
     mqttclient.connected_flag = False
 
 def mqttOnMessage(mqttclient, userdata, message):
-    print("message received",str(message.payload.decode("utf-8")),"topic",message.topic)
-    evaluateCommand(message.topic, str(message.payload.decode("utf-8")))
+    global COMMAND_TRACES
+
+    try:
+        command = str(message.payload.decode("utf-8"))
+        decoded = True
+    except UnicodeDecodeError:
+        command = str(message.payload.decode("utf-8", errors="replace"))
+        decoded = False
+
+    trace = newCommandTrace(message.topic, command)
+    print("message received",command,"topic",message.topic,"trace",trace["trace_id"])
+
+    if not decoded:
+        mqttPushCommandResult(mqttclient, trace, "reject", True, "undecodable payload")
+        return
+
+    door, reason = evaluateCommand(message.topic, command)
+    if not door:
+        mqttPushCommandResult(mqttclient, trace, "reject", True, reason)
+        return
+    trace["door"] = door
+
+    changes_state = commandChangesState(door, command)
+    if changes_state:
+        # register before dispatch, so no state publish caused by this command is missed
+        superseded = registerCommandTrace(trace)
+        if superseded is not None:
+            mqttFinishCommandTrace(mqttclient, superseded, "superseded", {"superseded_by": trace["trace_id"]})
+
+    executeCommand(door, command, trace)
+
+    if not changes_state:
+        data = recordLatencies(door, command, traceTimings(trace), "ack")
+        mqttPushCommandResult(mqttclient, trace, "ack", True, extra=data)
+        return
+
+    with TRACE_LOCK:
+        trace["dispatched"] = True
+
+    # acknowledge receipt and relay timings now, the complete ack follows with the first state publish
+    timings = {stage: latency for stage, latency in traceTimings(trace).items() if stage != "state_publish"}
+    mqttPushCommandResult(mqttclient, trace, "ack", False, extra=recordLatencies(door, command, timings))
+
+    with TRACE_LOCK:
+        trace["acked"] = True
+        finished = "state_publish" in trace["timings"] and COMMAND_TRACES.get(door) is trace
+        if finished:
+            COMMAND_TRACES.pop(door)
+
+    if finished:
+        mqttFinishCommandTrace(mqttclient, trace, "ack")
 
 def mqttGetAndPushCPUTemp(mqttclient):
   global STAT_CACHE
@@ -403,6 +619,7 @@ def mqttGetAndPushDoorState(mqttclient):
     #until every state was changed by door movement
 
     if CONFIG["garage"]["enabled"]:
+        published = False
         state, position = calculateDoorPosition("garage")
         if state == "VENTING":
             venting = "ON" 
@@ -412,6 +629,7 @@ def mqttGetAndPushDoorState(mqttclient):
         if venting != STAT_CACHE["garage"]["venting"]:
             mqttclient.publish(CONFIG["garage"]["mqtt"]["topic"] + "/venting", venting, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["garage"]["venting"] = venting
+            published = True
 
         if state != STAT_CACHE["garage"]["state"]:
             if state == "VENTING":
@@ -419,18 +637,24 @@ def mqttGetAndPushDoorState(mqttclient):
             else:
                 mqttclient.publish(CONFIG["garage"]["mqtt"]["topic"] + "/state", state, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["garage"]["state"] = state
+            published = True
         
         if position != STAT_CACHE["garage"]["position"]:
             mqttclient.publish(CONFIG["garage"]["mqtt"]["topic"] + "/position", position, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["garage"]["position"] = position
+            published = True
         
         #Read the Light
         light = getLight()
         if light != STAT_CACHE["garage"]["light"]:
           mqttclient.publish(CONFIG["garage"]["mqtt"]["topic"] + "/light", light, qos=CONFIG["mqtt"]["qos"], retain=True)
           STAT_CACHE["garage"]["light"] = light
+          published = True
+
+        mqttCloseCommandTrace(mqttclient, "garage", published)
 
     if CONFIG["fence"]["enabled"]:
+        published = False
         state, position = calculateDoorPosition("fence")
         if state == "HALF":
             venting = "ON" 
@@ -441,14 +665,19 @@ def mqttGetAndPushDoorState(mqttclient):
         if venting != STAT_CACHE["fence"]["half"]:
             mqttclient.publish(CONFIG["fence"]["mqtt_topic"] + "/half", venting, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["fence"]["half"] = venting
+            published = True
 
         if state != STAT_CACHE["fence"]["state"]:
             mqttclient.publish(CONFIG["fence"]["mqtt_topic"] + "/state", state, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["fence"]["state"] = state
+            published = True
         
         if position != STAT_CACHE["fence"]["position"]:
             mqttclient.publish(CONFIG["fence"]["mqtt_topic"] + "/position", position, qos=CONFIG["mqtt"]["qos"], retain=True)
             STAT_CACHE["fence"]["position"] = position
+            published = True
+
+        mqttCloseCommandTrace(mqttclient, "fence", published)
 
 
 def mqttInitialize():
@@ -650,7 +879,7 @@ def main():
             mqttGetAndPushCPUTemp(mqttclient)
             mqttGetAndPushDoorState(mqttclient)
 
-        time.sleep(5.0 - time.time() % 5.0)
+        time.sleep(POLL_INTERVAL - time.time() % POLL_INTERVAL)
     
     #end while loopEnabled
     